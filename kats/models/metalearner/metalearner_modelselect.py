@@ -11,7 +11,8 @@ This module contains:
 
 import ast
 import logging
-from collections import Counter, defaultdict
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import joblib
@@ -22,7 +23,7 @@ import seaborn as sns
 from kats.consts import TimeSeriesData
 from kats.tsfeatures.tsfeatures import TsFeatures
 from sklearn import metrics
-from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.naive_bayes import GaussianNB
 from sklearn.neighbors import KNeighborsClassifier
@@ -30,13 +31,33 @@ from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
 
+try:
+    from sklearn.ensemble import HistGradientBoostingClassifier
+except ImportError:  # scikit-learn < 1.0
+    from sklearn.experimental import enable_hist_gradient_boosting  # noqa
+    from sklearn.ensemble import HistGradientBoostingClassifier
+
+
+def _aggregate_errors(
+    errors: np.ndarray, codes: np.ndarray, use_median: bool
+) -> np.ndarray:
+    """Helper function to aggregate the errors of the selected models and of each candidate model.
+
+    Returns an array whose first element is the aggregated error of the models selected by codes,
+    followed by the aggregated error of each column of errors.
+    """
+
+    em = np.median if use_median else np.mean
+    selected = errors[np.arange(len(codes)), codes]
+    return np.concatenate(([em(selected)], em(errors, axis=0)))
+
 
 class MetaLearnModelSelect:
     """Meta-learner framework on forecasting model selection.
     This framework uses classification algorithms to recommend suitable forecasting models.
     For training, it uses time series features as inputs and the best forecasting models as labels.
     For prediction, it takes time series or time series features as inputs to predict the most suitable forecasting model.
-    The class provides count_category, preprocess, plot_feature_comparison, get_corr_mtx, plot_corr_heatmap, train, pred, pred_by_feature, pred_fuzzy, load_model and save_model.
+    The class provides count_category, preprocess, plot_feature_comparison, get_corr_mtx, plot_corr_heatmap, train, pred, pred_many, pred_by_feature, pred_fuzzy, load_model and save_model.
 
     Attributes:
         metadata: Optional; A list of dictionaries representing the meta-data of time series (e.g., the meta-data generated by GetMetaData object).
@@ -50,11 +71,15 @@ class MetaLearnModelSelect:
         >>> mlms.train(n_trees=200, test_size=0.1, eval_method='mean') # Train a meta-learner model selection model.
         >>> mlms.pred(TSdata) # Predict/recommend forecasting model for a new time series data.
         >>> mlms2.pred(TSdata, n_top=3) # Predict/recommend the top 3 most suitable forecasting model.
+        >>> mlms.pred_many([TSdata1, TSdata2]) # Predict/recommend forecasting models for a list of time series data.
         >>> mlms.save_model("mlms.pkl") # Save the trained model.
         >>> mlms2 = MetaLearnModelSelect(metadata=None, load_model=True) # Create a new object and then load a pre-trained model.
         >>> mlms2.load_model("mlms.pkl")
     """
 
+    # feature extractor shared across instances, TsFeatures.transform does not modify its state
+    _ts_features: Optional[TsFeatures] = None
+
     def __init__(
         self, metadata: Optional[List[Dict[str, Any]]] = None, load_model: bool = False
     ) -> None:
@@ -89,6 +114,7 @@ class MetaLearnModelSelect:
             self.metadata = metadata
             self._reorganize_data()
             self._validate_data()
+            self._set_hpt_errors()
 
             self.scale = False
             self.clf = None
@@ -98,46 +124,61 @@ class MetaLearnModelSelect:
             msg = "Fail to initiate MetaLearnModelSelect."
             raise ValueError(msg)
 
+    @property
+    def _tsf(self) -> TsFeatures:
+        cls = type(self)
+        if cls._ts_features is None:
+            cls._ts_features = TsFeatures()
+        return cls._ts_features
+
     def _reorganize_data(self) -> None:
-        hpt_list = []
-        metadataX_list = []
-        metadataY_list = []
-        for i in range(len(self.metadata)):
-            if isinstance(self.metadata[i]["hpt_res"], str):
-                hpt_list.append(ast.literal_eval(self.metadata[i]["hpt_res"]))
-            else:
-                hpt_list.append(self.metadata[i]["hpt_res"])
-
-            if isinstance(self.metadata[i]["features"], str):
-                metadataX_list.append(
-                    list(ast.literal_eval(self.metadata[i]["features"]).values())
-                )
-            else:
-                metadataX_list.append(list(self.metadata[i]["features"].values()))
+        hpt_list = [d["hpt_res"] for d in self.metadata]
+        if isinstance(hpt_list[0], str):
+            hpt_list = [ast.literal_eval(hpt) for hpt in hpt_list]
+
+        feature_dicts = [d["features"] for d in self.metadata]
+        if isinstance(feature_dicts[0], str):
+            feature_dicts = [ast.literal_eval(f) for f in feature_dicts]
+
+        metadataY_list = [d["best_model"] for d in self.metadata]
+
+        self.col_namesX = list(feature_dicts[0].keys())
+        # 1-d object array, built element-wise so that list entries are not broadcast into extra dimensions
+        self.hpt = np.empty(len(hpt_list), dtype=object)
+        self.hpt[:] = hpt_list
+        # store raw features in single precision, which is what the tree models use internally
+        self.metadataX = (
+            pd.DataFrame.from_records(feature_dicts, columns=self.col_namesX)
+            .fillna(0)
+            .astype(np.float32)
+        )
+        self.metadataY = pd.Series(metadataY_list, name="y", dtype="category")
 
-            metadataY_list.append(self.metadata[i]["best_model"])
+    def _set_hpt_errors(self) -> None:
+        # dense error matrix of hpt, _hpt_errors[i, k] is the error of the k-th candidate model on the i-th sample
+        self._hpt_classes = np.asarray(self.metadataY.unique())
+        self._hpt_errors = self._error_matrix(self.hpt, list(self._hpt_classes))
 
-        self.col_namesX = list(self.metadata[0]["features"].keys())
-        self.hpt = pd.Series(hpt_list, name="hpt")
-        self.metadataX = pd.DataFrame(metadataX_list, columns=self.col_namesX)
-        self.metadataX.fillna(0, inplace=True)
-        self.metadataY = pd.Series(metadataY_list, name="y")
-        self.x_mean = np.average(self.metadataX.values, axis=0)
-        self.x_std = np.std(self.metadataX.values, axis=0)
-        self.x_std[self.x_std == 0] = 1.0
+    @property
+    def _hpt_error_matrix(self) -> Tuple[np.ndarray, List[str]]:
+        # models saved before the error matrix was cached only have hpt, so build it on first use
+        if "_hpt_errors" not in self.__dict__:
+            self._set_hpt_errors()
+        return self._hpt_errors, list(self._hpt_classes)
 
     def _validate_data(self):
-        num_class = self.metadataY.nunique()
+        counts = self.metadataY.value_counts(sort=False)
+        num_class = counts.size
         if num_class == 1:
             msg = "Only one class in the label column (best_model), not able to train a classifier!"
             logging.error(msg)
             raise ValueError(msg)
 
-        local_count = list(self.count_category().values())
-        if min(local_count) * num_class < 30:
+        lo, hi = int(counts.min()), int(counts.max())
+        if lo * num_class < 30:
             msg = "Not recommend to do downsampling! Dataset will be too small after downsampling!"
             logging.info(msg)
-        elif max(local_count) > min(local_count) * 5:
+        elif hi > lo * 5:
             msg = "Number of obs in majority class is much greater than in minority class. Downsampling is recommended!"
             logging.info(msg)
         else:
@@ -151,7 +192,7 @@ class MetaLearnModelSelect:
             A dictionary storing the number of observations of each candidate model in meta-data.
         """
 
-        return Counter(self.metadataY)
+        return self.metadataY.value_counts(sort=False).to_dict()
 
     def preprocess(self, downsample: bool = True, scale: bool = False) -> None:
         """Pre-process meta data before training a classifier.
@@ -172,14 +213,20 @@ class MetaLearnModelSelect:
             self.hpt, self.metadataX, self.metadataY = RandomDownSampler(
                 self.hpt, self.metadataX, self.metadataY
             ).fit_resample()
+            self._set_hpt_errors()
             logging.info("Successfully applied random downsampling!")
-            self.x_mean = np.average(self.metadataX.values, axis=0)
-            self.x_std = np.std(self.metadataX.values, axis=0)
-            self.x_std[self.x_std == 0] = 1.0
 
         if scale:
             self.scale = True
-            self.metadataX = (self.metadataX - self.x_mean) / self.x_std
+            arr = self.metadataX.to_numpy(dtype=float, copy=True)
+            scaler = StandardScaler().fit(arr)
+            self.x_mean = scaler.mean_
+            self.x_std = np.where(scaler.scale_ == 0, 1.0, scaler.scale_)
+            arr -= self.x_mean
+            arr /= self.x_std
+            self.metadataX = pd.DataFrame(
+                arr, index=self.metadataX.index, columns=self.col_namesX, copy=False
+            )
             logging.info(
                 "Successfully scaled data by centering to the mean and component-wise scaling to unit variance!"
             )
@@ -242,9 +289,10 @@ class MetaLearnModelSelect:
 
         Args:
             method: Optional; A string representing the name of the classification algorithm. Can be 'RandomForest', 'GBDT', 'SVM', 'KNN' or 'NaiveBayes'. Default is 'RandomForest'.
+                    'GBDT' uses the histogram-based gradient boosting classifier (`sklearn.ensemble.HistGradientBoostingClassifier`).
             eval_method: Optional; A string representing the aggregation method used for computing errors. Can be 'mean' or 'median'. Default is 'mean'.
             test_size: Optional; A float representing the proportion of test set, which should be within (0, 1). Default is 0.1.
-            n_trees: Optional; An integer representing the number of trees in random forest model. Default is 500.
+            n_trees: Optional; An integer representing the number of trees in random forest model (built in parallel on all available cores), or the number of boosting iterations in GBDT model. Default is 500.
             n_neighbors: Optional; An integer representing the number of neighbors in KNN model. Default is 5.
 
         Returns:
@@ -266,16 +314,22 @@ class MetaLearnModelSelect:
             logging.error(msg)
             raise ValueError(msg)
 
-        x_train, x_test, y_train, y_test, hpt_train, hpt_test = train_test_split(
-            self.metadataX, self.metadataY, self.hpt, test_size=test_size
+        hpt_errors, classes = self._hpt_error_matrix
+        x_train, x_test, y_train, y_test, e_train, e_test = train_test_split(
+            self.metadataX, self.metadataY, hpt_errors, test_size=test_size
         )
 
         if method == "RandomForest":
-            clf = RandomForestClassifier(n_estimators=n_trees)
+            clf = RandomForestClassifier(n_estimators=n_trees, n_jobs=-1)
         elif method == "GBDT":
-            clf = GradientBoostingClassifier()
+            clf = HistGradientBoostingClassifier(max_iter=n_trees)
         elif method == "SVM":
-            clf = make_pipeline(StandardScaler(), SVC(gamma="auto"))
+            # features are already standardized if scale was applied in preprocess
+            clf = (
+                SVC(gamma="auto")
+                if self.scale
+                else make_pipeline(StandardScaler(), SVC(gamma="auto"))
+            )
         elif method == "KNN":
             clf = KNeighborsClassifier(n_neighbors=n_neighbors)
         else:
@@ -288,25 +342,17 @@ class MetaLearnModelSelect:
         # calculate model errors
         fit_error, pred_error = {}, {}
 
-        # evaluate method
-        em = np.mean if eval_method == "mean" else np.median
-
-        # meta learning errors
-        fit_error["meta-learn"] = em(
-            [hpt_train.iloc[i][c][-1] for i, c in enumerate(y_fit)]
+        # meta learning errors followed by pre-selected model errors, for all candidate models
+        use_median = eval_method == "median"
+        fit_agg = _aggregate_errors(
+            e_train, pd.Index(classes).get_indexer(y_fit), use_median
         )
-        pred_error["meta-learn"] = em(
-            [hpt_test.iloc[i][c][-1] for i, c in enumerate(y_pred)]
+        pred_agg = _aggregate_errors(
+            e_test, pd.Index(classes).get_indexer(y_pred), use_median
         )
-
-        # pre-selected model errors, for all candidate models
-        for label in self.metadataY.unique():
-            fit_error[label] = em(
-                [hpt_train.iloc[i][label][-1] for i in range(len(hpt_train))]
-            )
-            pred_error[label] = em(
-                [hpt_test.iloc[i][label][-1] for i in range(len(hpt_test))]
-            )
+        for name, fit, pred in zip(["meta-learn"] + classes, fit_agg, pred_agg):
+            fit_error[name] = fit
+            pred_error[name] = pred
 
         self.clf = clf
         return {
@@ -315,6 +361,16 @@ class MetaLearnModelSelect:
             "clf_accuracy": metrics.accuracy_score(y_test, y_pred),
         }
 
+    @staticmethod
+    def _error_matrix(hpt: np.ndarray, classes: List[str]) -> np.ndarray:
+        """Helper function to gather the errors of all candidate models into an array of shape (len(hpt), len(classes))."""
+
+        return np.fromiter(
+            (row[c][-1] for row in hpt for c in classes),
+            dtype=float,
+            count=len(hpt) * len(classes),
+        ).reshape(len(hpt), len(classes))
+
     def save_model(self, file_name: str) -> None:
         """Save the trained model.
 
@@ -330,7 +386,11 @@ class MetaLearnModelSelect:
             logging.error(msg)
             raise ValueError(msg)
         else:
-            joblib.dump(self.__dict__, file_name)
+            # raw metadata is already reorganized into hpt, metadataX and metadataY
+            model = {k: v for k, v in self.__dict__.items() if k != "metadata"}
+            joblib.dump(
+                model, file_name, compress=("zlib", 3), protocol=pickle.HIGHEST_PROTOCOL
+            )
             logging.info("Successfully saved the trained model!")
 
     def load_model(self, file_name: str) -> None:
@@ -365,27 +425,72 @@ class MetaLearnModelSelect:
             A string or a list of strings of the names of forecasting models.
         """
 
-        ts = TimeSeriesData(pd.DataFrame(source_ts.to_dataframe().copy()))
         if self.clf is None:
             msg = "Haven't trained a model. Please train a model or load a model before predicting."
             logging.error(msg)
             raise ValueError(msg)
 
+        new_features_vector = self._get_features(source_ts, ts_scale)
+        return self.pred_by_feature(new_features_vector[None, :], n_top=n_top)[0]
+
+    def pred_many(
+        self, source_ts_list: List[TimeSeriesData], ts_scale: bool = True, n_top: int = 1
+    ) -> np.ndarray:
+        """Predict the best forecasting models for a list of new time series data.
+
+        Features of the time series are calculated concurrently in a thread pool and all time series are classified in a single batch.
+
+        Args:
+            source_ts_list: A list of :class:`kats.consts.TimeSeriesData` objects representing the new time series data.
+            ts_scale: Optional; A boolean to specify whether or not to rescale time series data (i.e., normalizing it with its maximum vlaue) before calculating features. Default is True.
+            n_top: Optional; A integer for the number of top model names to return. Default is 1.
+
+        Returns:
+            An array of strings representing the forecasing models. If n_top=1, a 1-d np.ndarray will be returned. Otherwise, a 2-d np.ndarray will be returned.
+        """
+
+        if self.clf is None:
+            msg = "Haven't trained a model. Please train a model or load a model before predicting."
+            logging.error(msg)
+            raise ValueError(msg)
+        if len(source_ts_list) == 0:
+            msg = "No time series to predict. Please provide a non-empty list of time series."
+            logging.error(msg)
+            raise ValueError(msg)
+
+        with ThreadPoolExecutor() as executor:
+            features = list(
+                executor.map(
+                    lambda ts: self._get_features(ts, ts_scale), source_ts_list
+                )
+            )
+        return self.pred_by_feature(np.vstack(features), n_top=n_top)
+
+    def _get_features(self, source_ts: TimeSeriesData, ts_scale: bool) -> np.ndarray:
+        """Helper function to calculate the features vector of a time series."""
+
+        ts = source_ts
         if ts_scale:
             # scale time series to make ts features more stable
-            ts.value /= ts.value.max()
+            ts = TimeSeriesData(
+                time=source_ts.time, value=source_ts.value / source_ts.value.max()
+            )
             msg = "Successful scaled! Each value of TS has been divided by the max value of TS."
             logging.info(msg)
 
-        new_features = TsFeatures().transform(ts)
-        new_features_vector = np.asarray(list(new_features.values()))
-        if np.any(np.isnan(new_features_vector)):
+        new_features = self._tsf.transform(ts)
+        new_features_vector = np.fromiter(
+            new_features.values(), dtype=float, count=len(new_features)
+        )
+        nans = np.isnan(new_features_vector)
+        if nans.any():
             msg = (
                 "Features of the test time series contains NaN value, consider processing it. Features are: "
                 f"{new_features}. Fill in NaNs with 0."
             )
             logging.warning(msg)
-        return self.pred_by_feature([new_features_vector], n_top=n_top)[0]
+            new_features_vector[nans] = 0.0
+        return new_features_vector
 
     def pred_by_feature(
         self,
@@ -406,33 +511,47 @@ class MetaLearnModelSelect:
             logging.error(msg)
             raise ValueError(msg)
         if isinstance(source_x, List):
-            x = np.row_stack(source_x)
+            try:
+                x = np.asarray(source_x, dtype=float)
+            except ValueError:
+                # elements of different shapes, e.g. a mix of 1-d and 2-d arrays
+                x = None
+            if x is None or x.ndim != 2:
+                x = np.vstack(source_x)
         elif isinstance(source_x, np.ndarray):
-            x = source_x.copy()
+            x = source_x
         else:
             msg = f"Invalid source_x type: {type(source_x)}."
             logging.error(msg)
             raise ValueError(msg)
         if self.scale:
-            x = (x - self.x_mean) / self.x_std
-        x[np.isnan(x)] = 0.0
+            x = x - self.x_mean
+            x /= self.x_std
+        nans = np.isnan(x)
+        if nans.any():
+            # only copy user's input when NaNs have to be filled in
+            if x is source_x:
+                x = x.copy()
+            x[nans] = 0.0
         if n_top == 1:
             return self.clf.predict(x)
         prob = self.clf.predict_proba(x)
-        order = np.argsort(-prob, axis=1)
         classes = np.array(self.clf.classes_)
-        return classes[order][:, :n_top]
+        if n_top >= prob.shape[1]:
+            return classes[np.argsort(-prob, axis=1)]
+        # only sort the n_top most probable classes
+        top = np.argpartition(-prob, n_top - 1, axis=1)[:, :n_top]
+        order = np.argsort(-np.take_along_axis(prob, top, axis=1), axis=1)
+        return classes[np.take_along_axis(top, order, axis=1)]
 
     def _bootstrap(self, data: np.ndarray, rep: int = 200) -> float:
         """Helper function for bootstrap test and returns the pvalue."""
 
         diff = data[:, 0] - data[:, 1]
         n = len(diff)
-        idx = np.random.choice(np.arange(n), n * rep)
-        sample = diff[idx].reshape(-1, n)
-        bs = np.average(sample, axis=1)
-        pvalue = np.average(bs < 0)
-        return pvalue
+        idx = np.random.randint(0, n, size=(rep, n))
+        bs = diff[idx].mean(axis=1)
+        return float((bs < 0).mean())
 
     def pred_fuzzy(
         self, source_ts: TimeSeriesData, ts_scale: bool = True, sig_level: float = 0.2
@@ -452,19 +571,19 @@ class MetaLearnModelSelect:
             A dictionary of prediction results, including forecasting models, their probability of being th best forecasting models and the pvalues of bootstrap tests.
         """
 
-        ts = TimeSeriesData(pd.DataFrame(source_ts.to_dataframe().copy()))
-        if ts_scale:
-            # scale time series to make ts features more stable
-            ts.value /= ts.value.max()
-        test = np.asarray(list(TsFeatures().transform(ts).values()))
-        test[np.isnan(test)] = 0.0
+        test = self._get_features(source_ts, ts_scale)
         if self.scale:
             test = (test - self.x_mean) / self.x_std
         test = test.reshape([1, -1])
-        m = len(self.clf.estimators_)
-        data = np.array(
-            [self.clf.estimators_[i].predict_proba(test)[0] for i in range(m)]
+        # query the raw tree structures directly to skip the per-tree input validation of predict_proba
+        test_32 = np.ascontiguousarray(test, dtype=np.float32)
+        n_classes = len(self.clf.classes_)
+        data = np.vstack(
+            [est.tree_.predict(test_32)[:, :n_classes] for est in self.clf.estimators_]
         )
+        normalizer = data.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0.0] = 1.0
+        data /= normalizer
         prob = self.clf.predict_proba(test)[0]
         idx = np.argsort(-prob)[:2]
         pvalue = self._bootstrap(data[:, idx[:2]])
@@ -487,43 +606,39 @@ class RandomDownSampler:
     RandomDownSampler provides methods for creating a balanced dataset via downsampling. It contains fit_resample.
 
     Attributes:
-        hpt: A `pandas.Series` object storing the best hyper-parameters and the corresponding errors for each model.
+        hpt: A 1-d `numpy.ndarray` of objects storing the best hyper-parameters and the corresponding errors for each model.
         dataX: A `pandas.DataFrame` object representing the time series features matrix.
         dataY: A `pandas.Series` object representing the best models for the corresponding time series.
     """
 
-    def __init__(self, hpt: pd.Series, dataX: pd.DataFrame, dataY: pd.Series) -> None:
+    def __init__(self, hpt: np.ndarray, dataX: pd.DataFrame, dataY: pd.Series) -> None:
         self.hpt = hpt
         self.dataX = dataX
         self.dataY = dataY
         self.col_namesX = self.dataX.columns
 
-    def fit_resample(self) -> Tuple[pd.Series, pd.DataFrame, pd.Series]:
+    def fit_resample(self) -> Tuple[np.ndarray, pd.DataFrame, pd.Series]:
         """Create balanced dataset via random downsampling.
 
         Returns:
-            A tuple containing the `pandas.Series` object of the best hyper-parameters and the corresponding errors, the `pandas.DataFrame` object of the downsampled time series features,
+            A tuple containing the `numpy.ndarray` object of the best hyper-parameters and the corresponding errors, the `pandas.DataFrame` object of the downsampled time series features,
             and the `pandas.Series` object of the downsampled best models for the corresponding time series.
         """
 
-        resampled_x, resampled_y, resampled_hpt = [], [], []
         # naive down-sampler technique for data imbalance problem
-        min_n = min(Counter(self.dataY).values())
+        codes, uniques = pd.factorize(self.dataY.values)
+        min_n = int(np.bincount(codes).min())
 
-        idx_dict = defaultdict(list)
-        for i, c in enumerate(self.dataY):
-            idx_dict[c].append(i)
-
-        for key in idx_dict:
-            idx_dict[key] = np.random.choice(idx_dict[key], size=min_n, replace=False)
-            resampled_x += self.dataX.iloc[np.asarray(idx_dict[key]), :].values.tolist()
-            resampled_y += list(self.dataY.iloc[np.asarray(idx_dict[key])])
-            resampled_hpt += list(self.hpt.iloc[np.asarray(idx_dict[key])])
-
-        resampled_x = pd.DataFrame(resampled_x)
-        resampled_x.columns = self.col_namesX
+        idx_dict = {}
+        for k, key in enumerate(uniques):
+            idx_dict[key] = np.random.choice(
+                np.where(codes == k)[0], size=min_n, replace=False
+            )
+        all_idx = np.concatenate(list(idx_dict.values()))
 
-        resampled_y = pd.Series(resampled_y, name="y")
-        resampled_hpt = pd.Series(resampled_hpt, name="hpt")
+        resampled_x = self.dataX.iloc[all_idx].reset_index(drop=True)
+        resampled_y = self.dataY.iloc[all_idx].reset_index(drop=True)
+        # models saved before hpt was stored as an ndarray hold a pd.Series
+        resampled_hpt = np.asarray(self.hpt)[all_idx]
 
         return resampled_hpt, resampled_x, resampled_y
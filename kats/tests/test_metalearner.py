@@ -260,6 +260,14 @@ class MetaLearnModelSelectTest(TestCase):
             msg = f"Prediction is not consistent! Results are: self.pred: {pred}, self.pred_fuzzy: {pred_fuzzy}, self.pred(, n_top=2): {pred_all}"
             logging.error(msg)
             raise ValueError(msg)
+        # Test pred_many and its consistency
+        pred_many = mlms.pred_many([t2, t1])
+        pred_many_all = mlms.pred_many([t2, t1], n_top=2)
+        if pred_many[0] != pred or np.sum(pred_many != pred_many_all[:, 0]) > 0:
+            msg = f"pred_many method is not consistent. Results are: self.pred: {pred}, self.pred_many: {pred_many}, self.pred_many(, n_top=2): {pred_many_all}"
+            logging.error(msg)
+            raise ValueError(msg)
+        self.assertRaises(ValueError, mlms.pred_many, [])
         # Test case for time series with nan features
         _ = mlms.pred(t1)
         # Test pred_by_feature and its consistency
@@ -277,6 +285,19 @@ class MetaLearnModelSelectTest(TestCase):
         # Test if the features keep their original values
         equals(feature, feature2)
 
+    def test_pred_by_feature_keeps_input(self) -> None:
+        samples = generate_meta_data(n=35)
+        mlms = MetaLearnModelSelect(samples)
+        mlms.preprocess(downsample=False, scale=False)
+        mlms.train(method="RandomForest")
+
+        # features with inf values (and no NaN) are rejected by the classifier but must not be modified
+        feature = np.random.randn(3 * mlms.metadataX.shape[1]).reshape(3, -1)
+        feature[0, 0] = np.inf
+        feature2 = feature.copy()
+        self.assertRaises(ValueError, mlms.pred_by_feature, feature)
+        self.assertTrue(np.array_equal(feature, feature2))
+
 
 class MetaLearnPredictabilityTest(TestCase):
     def test_initialize(self) -> None: